@@ -1,28 +1,48 @@
 """
 Text-to-SQL Pipeline : Agents + Workflow
 =========================================
-6 steps orchestrés par un Workflow Agno avec des class-based executors.
+5 steps orchestrés par un Workflow Agno avec des class-based executors.
 
-Question utilisateur → Intent → RAG Schema → SQL Generator → SQL Security → DB Executor → Response Formatter → Réponse
+Question utilisateur → RAG Schema → Intent + SQL Generator → SQL Security → DB Executor → Response Formatter → Réponse
 """
 
+import asyncio
+import contextvars
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from functools import cache, lru_cache
 from pathlib import Path
+from typing import Iterator
+from uuid import uuid4
 
+import httpx
+import sqlglot
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from sqlalchemy import Engine, create_engine, text
+from sqlglot import exp
 
 from agno.agent import Agent
 from agno.models.mistral import MistralChat
+from agno.run.agent import RunEvent, RunOutput
+from agno.run.base import RunStatus
 from agno.workflow.step import Step, StepInput, StepOutput
 from agno.workflow.workflow import Workflow
 from agno.knowledge.knowledge import Knowledge
-from agno.vectordb.pgvector import PgVector, SearchType
-from agno.knowledge.embedder.sentence_transformer import SentenceTransformerEmbedder
+from agno.vectordb.pgvector import PgVector, SearchType, HNSW
 from agno.knowledge.reader.markdown_reader import MarkdownReader
 from agno.knowledge.chunking.semantic import SemanticChunking
+from agno.db.base import SessionType
 from agno.db.postgres import PostgresDb
+from agno.db.utils import json_serializer
+from agno.models.message import Message
+from agno.session import AgentSession
 
+from embedder import CachedSentenceTransformerEmbedder
 from tools import execute_sql_readonly
 from guardrails import TopicGuardrail, SQLInjectionGuardrail, PromptInjectionGuardrail, OutputSafetyGuardrail
 
@@ -35,6 +55,20 @@ load_dotenv()
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 DB_URL = os.getenv("DATABASE_URL")
 KNOWLEDGE_PATH = Path(__file__).parent.parent / "knowledge" / "schema_docs.md"
+EMBEDDER_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDER_QUANTIZED = os.getenv("EMBEDDER_QUANTIZED", "1") != "0"
+# Nombre de tours précédents renvoyés au LLM avec chaque message (historique borné par session)
+HISTORY_RUNS = int(os.getenv("HISTORY_RUNS", "3"))
+# Streaming : fragments du LLM regroupés en un événement par STREAM_FLUSH_CHARS caractères
+# ou STREAM_FLUSH_INTERVAL secondes (moins d'aller-retours thread → boucle et d'écritures SSE)
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.05
+
+
+# Clients HTTP partagés par tous les modèles : connexions TLS keep-alive + multiplexage HTTP/2
+_HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+_http_client = httpx.Client(http2=True, timeout=60.0, limits=_HTTP_LIMITS)
+_async_http_client = httpx.AsyncClient(http2=True, timeout=60.0, limits=_HTTP_LIMITS)
 
 
 def get_model():
@@ -42,6 +76,7 @@ def get_model():
     return MistralChat(
         id="mistral-large-latest",
         api_key=MISTRAL_API_KEY,
+        client_params={"client": _http_client, "async_client": _async_http_client},
     )
 
 
@@ -49,42 +84,89 @@ def get_model():
 # CONFIGURATION DE LA MÉMOIRE (PostgreSQL)
 # ══════════════════════════════════════════════════════════════════════════════
 
-memory_db = PostgresDb(
-    db_url=DB_URL,
-    memory_table="pipeline_memories",
-)
+# Les ressources lourdes (modèle d'embedding, pools PostgreSQL) sont construites au premier appel
+@cache
+def get_db_engine() -> Engine:
+    """Engine SQLAlchemy (et son pool) partagé par la mémoire, les contenus et le vector DB.
+
+    Mêmes paramètres que l'engine qu'Agno crée lui-même à partir d'un db_url.
+    """
+    return create_engine(DB_URL, pool_pre_ping=True, pool_recycle=3600, json_serializer=json_serializer)
+
+
+@cache
+def get_memory_db() -> PostgresDb:
+    """Base de mémoire conversationnelle partagée par les agents."""
+    return PostgresDb(
+        db_engine=get_db_engine(),
+        memory_table="pipeline_memories",
+    )
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # KNOWLEDGE BASE (RAG Schema)
 # ══════════════════════════════════════════════════════════════════════════════
 
-# 1. Vector DB (PgVector + SentenceTransformer)
-vector_db = PgVector(
-    table_name="rag_schema_vectors",
-    db_url=DB_URL,
-    search_type=SearchType.hybrid,
-    embedder=SentenceTransformerEmbedder(id="sentence-transformers/all-MiniLM-L6-v2"),
-)
+# 1. Vector DB (PgVector + SentenceTransformer avec cache des embeddings)
+@cache
+def get_vector_db() -> PgVector:
+    """Vector DB du schéma ; le modèle d'embedding est chargé à ce moment-là."""
+    return PgVector(
+        table_name="rag_schema_vectors",
+        db_engine=get_db_engine(),
+        search_type=SearchType.hybrid,
+        vector_index=HNSW(m=16, ef_construction=64, ef_search=40),
+        embedder=CachedSentenceTransformerEmbedder(
+            id=EMBEDDER_ID,
+            quantized=EMBEDDER_QUANTIZED,
+            enable_batch=True,
+            batch_size=64,
+        ),
+    )
+
 
 # 2. Contents DB (stockage des documents bruts)
-contents_db = PostgresDb(
-    db_url=DB_URL,
-    knowledge_table="rag_schema_contents",
-)
+@cache
+def get_contents_db() -> PostgresDb:
+    return PostgresDb(
+        db_engine=get_db_engine(),
+        knowledge_table="rag_schema_contents",
+    )
+
 
 # 3. Knowledge Base
-schema_knowledge = Knowledge(
-    name="SQL Schema Knowledge",
-    vector_db=vector_db,
-    contents_db=contents_db,
-    max_results=5,
-)
+@cache
+def get_schema_knowledge() -> Knowledge:
+    return Knowledge(
+        name="SQL Schema Knowledge",
+        vector_db=get_vector_db(),
+        contents_db=get_contents_db(),
+        max_results=5,
+    )
+
+
+# 4. Chargement du schema_docs.md (ignoré si ni le fichier ni l'embedder n'ont changé depuis le
+#    dernier chargement) ; table créée par la migration 4
+KNOWLEDGE_META_TABLE = "rag_schema_contents_meta"
+
+
+def knowledge_index_version() -> str:
+    """Empreinte des vecteurs en base : fichier, modèle d'embedding et variante réellement chargée
+    (int8 ONNX ou fp32) — des vecteurs fp32 ne sont jamais interrogés avec des embeddings int8."""
+    embedder = get_vector_db().embedder
+    variant = "onnx-int8" if embedder.quantized else "fp32"
+    raw = "|".join([knowledge_version(), embedder.id, variant])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
 
-# 4. Chargement du schema_docs.md
 async def load_knowledge():
-    """Charge les documents RAG depuis le fichier Markdown."""
-    await schema_knowledge.add_content_async(
+    """Charge les documents RAG depuis le fichier Markdown, sauf si son empreinte est déjà en base."""
+    current_hash = await asyncio.to_thread(knowledge_index_version)
+    if await asyncio.to_thread(is_knowledge_up_to_date, current_hash):
+        print(f"[KB] Knowledge inchangée ({KNOWLEDGE_PATH.name}), chargement ignoré")
+        return
+
+    await get_schema_knowledge().add_content_async(
         path=str(KNOWLEDGE_PATH),
         reader=MarkdownReader(
             chunking_strategy=SemanticChunking(
@@ -93,116 +175,75 @@ async def load_knowledge():
             )
         ),
     )
+    await asyncio.to_thread(optimize_vector_index)
+    await asyncio.to_thread(store_knowledge_hash, current_hash)
     print(f"[KB] Knowledge chargée depuis {KNOWLEDGE_PATH.name}")
 
 
-# ══════════════════════════════════════════════════════════════════════════════
-# AGENT 1 : Intent Agent
-# ══════════════════════════════════════════════════════════════════════════════
-
-intent_agent = Agent(
-    name="Intent Agent",
-    model=get_model(),
-    description="Analyse et comprend la question de l'utilisateur.",
-    pre_hooks=[
-        TopicGuardrail(),
-        SQLInjectionGuardrail(),
-        PromptInjectionGuardrail(),
-    ],
-    db=memory_db,
-    enable_agentic_memory=True,
-    add_history_to_context=True,
-    instructions="""Tu analyses la question de l'utilisateur et extrais :
-    - L'intention : agrégation, filtrage, comparaison, tendance, détail
-    - Les entités : tables, colonnes, valeurs mentionnées
-    - Les contraintes : temporelles, géographiques, etc.
-
-    IMPORTANT : Si la question est une question de suivi (ex: "et à Lyon ?", "et pour les inactifs ?"),
-    utilise l'historique de la conversation pour comprendre le contexte complet.
-    Par exemple, si l'utilisateur a demandé "Combien de clients actifs à Paris ?" puis "et à Lyon ?",
-    tu dois comprendre qu'il veut "Combien de clients actifs à Lyon ?".
-
-    Retourne une analyse structurée en texte clair.
-    Exemple :
-    Intention : agrégation (comptage)
-    Entités : table clients, colonne ville, valeur "Paris", colonne statut, valeur "actif"
-    Contraintes : aucune contrainte temporelle
-
-    Ne génère PAS de SQL. Tu analyses uniquement la question.""",
-    markdown=True,
-)
-
-
-# ══════════════════════════════════════════════════════════════════════════════
-# AGENT 2 : RAG Schema Agent (singleton)
-# ══════════════════════════════════════════════════════════════════════════════
-
-rag_schema_agent = Agent(
-    name="RAG Schema Agent",
-    model=get_model(),
-    description="Fournit le contexte technique (schéma DB, règles métier, exemples SQL).",
-    knowledge=schema_knowledge,
-    search_knowledge=True,
-    instructions="""À partir de l'analyse d'intention fournie, recherche dans ta knowledge base :
-    - La structure des tables pertinentes (colonnes, types, valeurs possibles)
-    - Les relations entre tables (clés étrangères, JOINs)
-    - Les règles métier applicables
-    - Les exemples SQL similaires
-
-    Retourne le contexte technique complet qui permettra de générer le SQL.
-    Ne génère PAS de SQL toi-même. Tu fournis uniquement le contexte.""",
-    markdown=True,
-)
-
-
-# ══════════════════════════════════════════════════════════════════════════════
-# AGENT 5 : DB Executor (singleton)
-# ══════════════════════════════════════════════════════════════════════════════
+def is_knowledge_up_to_date(current_hash: str) -> bool:
+    """Vrai si l'empreinte enregistrée correspond (fichier + embedder) et que les vecteurs sont présents."""
+    vector_db = get_vector_db()
+    with vector_db.Session() as sess:
+        stored_hash = sess.execute(
+            text(f"SELECT hash FROM {KNOWLEDGE_META_TABLE} WHERE key = :key"),
+            {"key": "schema_docs"},
+        ).scalar()
+    return stored_hash == current_hash and vector_db.exists() and vector_db.get_count() > 0
+
+
+def store_knowledge_hash(current_hash: str):
+    """Enregistre l'empreinte de la knowledge chargée (UPSERT)."""
+    with get_vector_db().Session() as sess, sess.begin():
+        sess.execute(
+            text(f"""
+                INSERT INTO {KNOWLEDGE_META_TABLE} (key, hash) VALUES (:key, :hash)
+                ON CONFLICT (key) DO UPDATE SET hash = EXCLUDED.hash, updated_at = NOW()
+            """),
+            {"key": "schema_docs", "hash": current_hash},
+        )
 
-db_executor_agent = Agent(
-    name="DB Executor",
-    model=get_model(),
-    description="Exécute la requête SQL validée sur la base de données.",
-    tools=[execute_sql_readonly],
-    instructions="""Tu reçois une requête SQL validée.
 
-    Si le message contient "REJETÉE" : ne fais rien, transmets le message de rejet.
-
-    Sinon : utilise l'outil execute_sql_readonly pour exécuter la requête.
-    Retourne le résultat brut (JSON avec colonnes et lignes).""",
-    markdown=True,
-)
+def optimize_vector_index():
+    """Crée les index HNSW (cosine) + GIN s'ils n'existent pas, puis rafraîchit les statistiques."""
+    vector_db = get_vector_db()
+    vector_db.optimize()
+    with vector_db.Session() as sess, sess.begin():
+        sess.execute(text(f"ANALYZE {vector_db.table.fullname}"))
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # AGENT 6 : Response Formatter
 # ══════════════════════════════════════════════════════════════════════════════
 
-response_formatter_agent = Agent(
-    name="Response Formatter",
-    model=get_model(),
-    description="Reformule les résultats SQL en réponse métier compréhensible.",
-    pre_hooks=[OutputSafetyGuardrail()],
-    db=memory_db,
-    enable_agentic_memory=True,
-    add_history_to_context=True,
-    instructions="""Tu reçois les résultats d'une requête SQL (JSON avec colonnes et lignes).
-
-    Reformule en langage naturel français, compréhensible pour un non-technicien.
-
-    Règles :
-    - Réponds en français courant
-    - Utilise des tableaux Markdown si plus de 2 lignes de résultats
-    - Arrondis les montants à 2 décimales avec le symbole €
-    - Ajoute un bref résumé / insight si pertinent
-    - Ne montre PAS la requête SQL
-    - Si le résultat est une erreur, explique poliment le problème
-
-    Exemple :
-    "Il y a 10 clients actifs à Paris. C'est la ville avec le plus de clients dans la base."
-    """,
-    markdown=True,
-)
+@cache
+def get_response_formatter_agent() -> Agent:
+    """Agent Response Formatter, construit au premier appel."""
+    return Agent(
+        name="Response Formatter",
+        model=get_model(),
+        description="Reformule les résultats SQL en réponse métier compréhensible.",
+        pre_hooks=[OutputSafetyGuardrail()],
+        db=get_memory_db(),
+        enable_agentic_memory=True,
+        add_history_to_context=True,
+        num_history_runs=HISTORY_RUNS,
+        instructions="""Tu reçois les résultats d'une requête SQL (JSON avec colonnes et lignes).
+
+        Reformule en langage naturel français, compréhensible pour un non-technicien.
+
+        Règles :
+        - Réponds en français courant
+        - Utilise des tableaux Markdown si plus de 2 lignes de résultats
+        - Arrondis les montants à 2 décimales avec le symbole €
+        - Ajoute un bref résumé / insight si pertinent
+        - Ne montre PAS la requête SQL
+        - Si le résultat est une erreur, explique poliment le problème
+
+        Exemple :
+        "Il y a 10 clients actifs à Paris. C'est la ville avec le plus de clients dans la base."
+        """,
+        markdown=True,
+    )
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -223,14 +264,17 @@ TABLE_RELATIONS = {
 }
 
 
-def build_sql_generator_instructions(allowed_tables: list[str]) -> str:
-    """Construit les instructions du SQL Generator limitées aux tables autorisées."""
+@lru_cache(maxsize=16)
+def build_intent_sql_instructions(allowed_set: frozenset[str]) -> str:
+    """Instructions de l'agent Intent + SQL Generator limitées aux tables autorisées.
+
+    Mémoïsées par ensemble de tables : texte identique d'un appel à l'autre (prefix cache LLM).
+    """
     table_lines = "\n    ".join(
-        TABLE_SCHEMAS[t] for t in allowed_tables if t in TABLE_SCHEMAS
+        schema for table, schema in TABLE_SCHEMAS.items() if table in allowed_set
     )
 
     relation_lines = []
-    allowed_set = set(allowed_tables)
     for table_pair, relation in TABLE_RELATIONS.items():
         if table_pair.issubset(allowed_set):
             relation_lines.append(relation)
@@ -239,9 +283,21 @@ def build_sql_generator_instructions(allowed_tables: list[str]) -> str:
     disallowed = ALL_TABLES - allowed_set
     disallowed_note = ""
     if disallowed:
-        disallowed_note = f"\n\n    INTERDIT : Tu n'as PAS accès aux tables suivantes : {', '.join(sorted(disallowed))}. Ne génère JAMAIS de SQL les référençant. Si la question concerne une table interdite, retourne UNIQUEMENT : REJETÉE : accès non autorisé à cette table. Ne substitue JAMAIS par une autre table."
+        disallowed_note = f"\n\n    INTERDIT : Tu n'as PAS accès aux tables suivantes : {', '.join(sorted(disallowed))}. Ne génère JAMAIS de SQL les référençant. Si la question concerne une table interdite, mets UNIQUEMENT « REJETÉE : accès non autorisé à cette table » dans le champ sql. Ne substitue JAMAIS par une autre table."
+
+    return f"""Tu analyses la question de l'utilisateur puis, à partir de cette analyse et du contexte schéma fourni, tu génères UNE requête SQL PostgreSQL.
+
+    ÉTAPE 1 — ANALYSE DE LA QUESTION :
+    - L'intention : agrégation, filtrage, comparaison, tendance, détail
+    - Les entités : tables, colonnes, valeurs mentionnées
+    - Les contraintes : temporelles, géographiques, etc.
 
-    return f"""À partir de l'intention analysée et du contexte schéma fourni, génère UNE requête SQL PostgreSQL.
+    IMPORTANT : Si la question est une question de suivi (ex: "et à Lyon ?", "et pour les inactifs ?"),
+    utilise l'historique de la conversation pour comprendre le contexte complet.
+    Par exemple, si l'utilisateur a demandé "Combien de clients actifs à Paris ?" puis "et à Lyon ?",
+    tu dois comprendre qu'il veut "Combien de clients actifs à Lyon ?".
+
+    ÉTAPE 2 — GÉNÉRATION SQL :
 
     TABLES DISPONIBLES (il n'en existe AUCUNE autre) :
     {table_lines}
@@ -265,39 +321,93 @@ def build_sql_generator_instructions(allowed_tables: list[str]) -> str:
     - Utilise des alias lisibles (AS nom_colonne)
     - Utilise les JOINs corrects selon les relations ci-dessus
 
-    Retourne UNIQUEMENT la requête SQL, sans explication.
-    Format : la requête SQL brute, rien d'autre."""
-
-
-def build_sql_security_instructions(allowed_tables: list[str]) -> str:
-    """Construit les instructions du SQL Security Agent limitées aux tables autorisées."""
-    table_list = ", ".join(allowed_tables)
-    return f"""Tu reçois une requête SQL. Vérifie :
+    FORMAT DE SORTIE : retourne UNIQUEMENT un objet JSON strict, sans markdown ni explication :
+    {{"intent": "Intention : ... / Entités : ... / Contraintes : ...", "sql": "la requête SQL brute"}}"""
+
+
+@lru_cache(maxsize=16)
+def get_intent_sql_agent(allowed_set: frozenset[str]) -> Agent:
+    """Agent Intent + SQL Generator (un seul appel LLM), construit une fois par ensemble de tables autorisées."""
+    return Agent(
+        name="Intent + SQL Generator",
+        model=get_model(),
+        description="Analyse la question de l'utilisateur et génère une requête SQL PostgreSQL.",
+        pre_hooks=[
+            TopicGuardrail(),
+            SQLInjectionGuardrail(),
+            PromptInjectionGuardrail(),
+        ],
+        db=get_memory_db(),
+        enable_agentic_memory=True,
+        add_history_to_context=True,
+        num_history_runs=HISTORY_RUNS,
+        instructions=build_intent_sql_instructions(allowed_set),
+    )
 
-    1. C'est un SELECT uniquement (pas de DROP, DELETE, UPDATE, INSERT, ALTER, TRUNCATE)
-    2. Pas de sous-requêtes destructrices
-    3. Pas de tentative d'injection SQL (commentaires --, ;, UNION non justifié)
-    4. Les tables référencées sont UNIQUEMENT parmi : {table_list}
-    5. Pas d'accès à des tables système (pg_*, information_schema)
-    6. AUCUNE référence à des tables non autorisées
 
-    Si la requête est SÛRE : retourne la requête SQL telle quelle, sans modification.
-    Si la requête est DANGEREUSE ou référence des tables non autorisées : retourne "REJETÉE : " suivi de l'explication du problème."""
+# Regex précompilées au chargement du module (hors du chemin critique)
+FROM_RE = re.compile(r'\bFROM\s+([a-zA-Z_]\w*)', re.IGNORECASE)
+JOIN_RE = re.compile(r'\bJOIN\s+([a-zA-Z_]\w*)', re.IGNORECASE)
+SQL_FENCE_RE = re.compile(r"```(?:sql)?\s*\n?(.*?)\n?```", re.DOTALL)
 
 
 def extract_table_names(sql: str) -> set[str]:
     """Extrait les noms de tables depuis une requête SQL (défense en profondeur)."""
-    tables = set()
-    patterns = [
-        r'\bFROM\s+([a-zA-Z_]\w*)',
-        r'\bJOIN\s+([a-zA-Z_]\w*)',
-    ]
-    for pattern in patterns:
-        for match in re.findall(pattern, sql, re.IGNORECASE):
-            tables.add(match.lower())
+    tables = {match.lower() for match in FROM_RE.findall(sql) + JOIN_RE.findall(sql)}
     return tables & ALL_TABLES
 
 
+# Nœuds AST interdits (écriture, DDL, commandes brutes, SELECT ... INTO)
+FORBIDDEN_NODES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Drop, exp.Create,
+    exp.Alter, exp.TruncateTable, exp.Command, exp.Into,
+)
+SYSTEM_SCHEMAS = {"pg_catalog", "information_schema"}
+FORBIDDEN_FUNCTION_PREFIXES = ("pg_", "dblink", "lo_", "set_config")
+
+
+def validate_sql(sql: str, allowed_tables: list[str]) -> str | None:
+    """Valide la requête de façon déterministe (AST sqlglot). Retourne le motif du rejet, ou None si sûre."""
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+    except sqlglot.errors.ParseError:
+        return "requête SQL invalide."
+
+    if len(statements) != 1:
+        return "une seule requête SQL est autorisée."
+    tree = statements[0]
+
+    if not isinstance(tree, (exp.Select, exp.Union, exp.Intersect, exp.Except)):
+        return "seules les requêtes SELECT sont autorisées."
+
+    for node in tree.walk():
+        if isinstance(node, FORBIDDEN_NODES):
+            return f"opération {node.key.upper()} interdite."
+        if isinstance(node, exp.Func):
+            name = (node.name if isinstance(node, exp.Anonymous) else node.sql_name()).lower()
+            if name.startswith(FORBIDDEN_FUNCTION_PREFIXES):
+                return f"fonction système {name} interdite."
+
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    referenced = set()
+    for table in tree.find_all(exp.Table):
+        name = table.name.lower()
+        if table.db.lower() in SYSTEM_SCHEMAS or name.startswith("pg_") or name in SYSTEM_SCHEMAS:
+            return f"accès aux tables système ({table.sql(dialect='postgres')}) interdit."
+        if name and name not in cte_names:
+            referenced.add(name)
+
+    unknown = referenced - ALL_TABLES
+    if unknown:
+        return f"tables inconnues : {', '.join(sorted(unknown))}."
+
+    unauthorized = (referenced | extract_table_names(sql)) - set(allowed_tables)
+    if unauthorized:
+        return f"vous n'avez pas la permission d'interroger les tables : {', '.join(sorted(unauthorized))}."
+
+    return None
+
+
 # Mots-clés associés à chaque table (pour détection dans la question utilisateur)
 TABLE_KEYWORDS = {
     "commandes": [
@@ -318,21 +428,35 @@ TABLE_KEYWORDS = {
 }
 
 
+# Une alternation compilée par table : un seul passage regex par table
+TABLE_KEYWORD_PATTERNS = {
+    table: re.compile("|".join(f"(?:{keyword})" for keyword in keywords))
+    for table, keywords in TABLE_KEYWORDS.items()
+}
+
+
 def detect_requested_tables(question: str) -> set[str]:
     """Détecte les tables référencées dans la question de l'utilisateur."""
     question_lower = question.lower()
-    detected = set()
-    for table, keywords in TABLE_KEYWORDS.items():
-        for keyword in keywords:
-            if re.search(keyword, question_lower):
-                detected.add(table)
-                break
-    return detected
+    return {table for table, pattern in TABLE_KEYWORD_PATTERNS.items() if pattern.search(question_lower)}
+
+
+def parse_intent_sql(text: str) -> tuple[str, str]:
+    """Parse la sortie JSON {"intent", "sql"} de l'agent fusionné. Repli : SQL extrait du texte brut."""
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+            if isinstance(data, dict) and isinstance(data.get("sql"), str):
+                return str(data.get("intent") or ""), extract_sql(data["sql"])
+        except json.JSONDecodeError:
+            pass
+    return "", extract_sql(text)
 
 
 def extract_sql(text: str) -> str:
     """Extrait la requête SQL du texte (enlève le markdown si présent)."""
-    match = re.search(r"```(?:sql)?\s*\n?(.*?)\n?```", text, re.DOTALL)
+    match = SQL_FENCE_RE.search(text)
     if match:
         return match.group(1).strip()
     return text.strip()
@@ -348,112 +472,166 @@ class PipelineState:
     def __init__(self, allowed_tables: list[str], session_id: str | None = None):
         self.allowed_tables = allowed_tables
         self.session_id = session_id
+        self.intent: str | None = None
         self.sql_query: str | None = None
 
 
-class IntentExecutor:
-    """Step 1 : Analyse l'intention de la question."""
-    def __init__(self, state: PipelineState):
-        self.state = state
+# État de la requête en cours : le Workflow est construit une seule fois et partagé entre les requêtes
+_pipeline_state: contextvars.ContextVar[PipelineState] = contextvars.ContextVar("pipeline_state")
 
-    def __call__(self, step_input: StepInput) -> StepOutput:
-        response = intent_agent.run(step_input.input, session_id=self.state.session_id)
-        return StepOutput(content=response.content or "")
 
+class StatefulExecutor:
+    """Base des executors : lit le PipelineState de la requête courante dans le ContextVar."""
+    @property
+    def state(self) -> PipelineState:
+        return _pipeline_state.get()
 
-class RAGSchemaExecutor:
-    """Step 2 : Récupère le contexte schéma via RAG."""
-    def __call__(self, step_input: StepInput) -> StepOutput:
-        response = rag_schema_agent.run(step_input.previous_step_content)
-        return StepOutput(content=response.content or "")
 
+def retrieve_schema_context(question: str) -> str:
+    """Contexte schéma déterministe : top-k chunks de la knowledge base, sans appel LLM."""
+    documents = get_schema_knowledge().search(query=question, max_results=5)
+    return "\n\n".join(doc.content for doc in documents if doc.content)
 
-class SQLGeneratorExecutor:
-    """Step 3 : Génère le SQL avec instructions dynamiques (RBAC)."""
-    def __init__(self, state: PipelineState):
-        self.state = state
 
+class SchemaRetrievalExecutor:
+    """Step 1 : Récupère le contexte schéma via RAG (recherche vectorielle, sans LLM)."""
     def __call__(self, step_input: StepInput) -> StepOutput:
-        agent = Agent(
-            name="SQL Generator",
-            model=get_model(),
-            description="Génère une requête SQL PostgreSQL.",
-            instructions=build_sql_generator_instructions(self.state.allowed_tables),
-            markdown=True,
-        )
-        response = agent.run(step_input.previous_step_content)
-        self.state.sql_query = extract_sql(response.content or "")
-        return StepOutput(content=response.content or "")
-
+        return StepOutput(content=retrieve_schema_context(step_input.input))
 
-class SQLSecurityExecutor:
-    """Step 4 : Valide la sécurité SQL + hard check regex. Stoppe le pipeline si rejeté."""
-    def __init__(self, state: PipelineState):
-        self.state = state
 
+class IntentSQLExecutor(StatefulExecutor):
+    """Step 2 : Analyse l'intention et génère le SQL en un seul appel LLM (agent mémoïsé, RBAC)."""
     def __call__(self, step_input: StepInput) -> StepOutput:
-        agent = Agent(
-            name="SQL Security Agent",
-            model=get_model(),
-            description="Valide la sécurité de la requête SQL générée.",
-            instructions=build_sql_security_instructions(self.state.allowed_tables),
-            markdown=True,
+        agent = get_intent_sql_agent(frozenset(self.state.allowed_tables))
+        # Question brute en entrée (guardrails + mémoire), contexte schéma ajouté au message
+        response = agent.run(
+            step_input.input,
+            session_id=self.state.session_id,
+            dependencies={"contexte_schema": step_input.previous_step_content or ""},
+            add_dependencies_to_context=True,
         )
-        response = agent.run(step_input.previous_step_content)
-        security_text = response.content or ""
+        self.state.intent, self.state.sql_query = parse_intent_sql(response.content or "")
+        return StepOutput(content=self.state.sql_query or response.content or "")
 
-        # Agent-level rejection
-        if "REJETÉE" in security_text.upper() or "REJETEE" in security_text.upper():
+
+class SQLSecurityExecutor(StatefulExecutor):
+    """Step 3 : Valide le SQL sans LLM (AST sqlglot + regex). Stoppe le pipeline si rejeté."""
+    def __call__(self, step_input: StepInput) -> StepOutput:
+        generator_text = step_input.previous_step_content or ""
+
+        # Rejet déjà décidé par l'agent Intent + SQL Generator (table interdite)
+        if "REJETÉE" in generator_text.upper() or "REJETEE" in generator_text.upper() or not self.state.sql_query:
             self.state.sql_query = None
             return StepOutput(
-                content=f"Requête SQL rejetée pour raison de sécurité : {security_text}",
+                content=f"Requête SQL rejetée pour raison de sécurité : {generator_text}",
                 success=False,
             )
 
-        # Hard check regex (defense in depth)
-        if self.state.sql_query:
-            referenced = extract_table_names(self.state.sql_query)
-            unauthorized = referenced - set(self.state.allowed_tables)
-            if unauthorized:
-                self.state.sql_query = None
-                return StepOutput(
-                    content=f"Accès refusé : vous n'avez pas la permission d'interroger les tables : {', '.join(sorted(unauthorized))}.",
-                    success=False,
-                )
+        reason = validate_sql(self.state.sql_query, self.state.allowed_tables)
+        if reason:
+            self.state.sql_query = None
+            return StepOutput(
+                content=f"Requête SQL rejetée pour raison de sécurité : {reason}",
+                success=False,
+            )
 
-        return StepOutput(content=security_text)
+        return StepOutput(content=self.state.sql_query)
 
 
-class DBExecutorExecutor:
-    """Step 5 : Exécute le SQL validé en base de données."""
+class DBExecutorExecutor(StatefulExecutor):
+    """Step 4 : Exécute le SQL validé en base de données (appel direct, sans LLM)."""
     def __call__(self, step_input: StepInput) -> StepOutput:
-        response = db_executor_agent.run(step_input.previous_step_content)
-        return StepOutput(content=response.content or "")
-
+        # Requête rejetée au step 3 : on transmet le message de rejet tel quel
+        if not self.state.sql_query:
+            return StepOutput(content=step_input.previous_step_content or "")
+        return StepOutput(content=execute_sql_readonly(self.state.sql_query))
 
-class ResponseFormatterExecutor:
-    """Step 6 : Formate la réponse finale en langage naturel."""
-    def __init__(self, state: PipelineState):
-        self.state = state
 
+class ResponseFormatterExecutor(StatefulExecutor):
+    """Step 5 : Formate la réponse finale en langage naturel."""
     def __call__(self, step_input: StepInput) -> StepOutput:
-        response = response_formatter_agent.run(
+        response = get_response_formatter_agent().run(
             step_input.previous_step_content, session_id=self.state.session_id
         )
         return StepOutput(content=response.content or "")
 
+    @staticmethod
+    def stream(previous_content: str, state: PipelineState) -> Iterator[str]:
+        """Variante streaming : produit les fragments de texte au fil de la génération.
+
+        L'état est passé explicitement : un générateur peut reprendre dans un autre contexte.
+        """
+        for event in get_response_formatter_agent().run(
+            previous_content, session_id=state.session_id, stream=True
+        ):
+            if event.event == RunEvent.run_content and event.content:
+                yield event.content
+
 
 # ══════════════════════════════════════════════════════════════════════════════
-# WORKFLOW PIPELINE
+# CACHE DES RÉPONSES
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Réponses finales en mémoire : une question répétée évite tout le pipeline
+_response_cache: TTLCache = TTLCache(maxsize=1024, ttl=600)
+_response_cache_lock = threading.Lock()
 
-def run_pipeline(question: str, session_id: str | None = None, allowed_tables: list[str] | None = None) -> dict:
-    """Exécute le pipeline Text-to-SQL via un Workflow Agno avec filtrage RBAC."""
-    if allowed_tables is None:
-        allowed_tables = list(ALL_TABLES)
 
-    # Pré-check : blocage strict si la question cible une table non autorisée
+@lru_cache(maxsize=1)
+def knowledge_version() -> str:
+    """Empreinte SHA-256 du schema_docs.md : invalide le cache et déclenche le rechargement si elle change."""
+    try:
+        return hashlib.sha256(KNOWLEDGE_PATH.read_bytes()).hexdigest()
+    except OSError:
+        return "none"
+
+
+def response_cache_key(question: str, allowed_tables: list[str]) -> str:
+    """Clé SHA-256 de (question normalisée, tables autorisées, version KB), commune à toutes les sessions."""
+    normalized = " ".join(question.lower().split())
+    raw = "|".join([normalized, ",".join(sorted(allowed_tables)), knowledge_version()])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def record_cached_turn(question: str, result: dict, session_id: str | None, allowed_tables: list[str]):
+    """Enregistre dans la mémoire Agno un tour servi depuis un cache (mémoire ou Redis).
+
+    Sans cela la session n'en garderait aucune trace et la question de suivi perdrait son contexte.
+    Chaque agent reçoit le run qu'il aurait produit : question → {"intent", "sql"} pour l'agent SQL,
+    question → réponse pour le formatter.
+    """
+    if not session_id:
+        return
+    db = get_memory_db()
+    intent_agent = get_intent_sql_agent(frozenset(allowed_tables))
+    formatter = get_response_formatter_agent()
+    for agent in (intent_agent, formatter):
+        agent.set_id()
+
+    session = db.get_session(session_id, SessionType.AGENT) or AgentSession(
+        session_id=session_id, agent_id=intent_agent.id, created_at=int(time.time())
+    )
+    sql_answer = json.dumps({"intent": "", "sql": result["sql_query"]}, ensure_ascii=False)
+    for agent, answer in ((intent_agent, sql_answer), (formatter, result["response"])):
+        session.upsert_run(RunOutput(
+            run_id=str(uuid4()),
+            session_id=session_id,
+            agent_id=agent.id,
+            agent_name=agent.name,
+            content=answer,
+            status=RunStatus.completed,
+            messages=[Message(role="user", content=question), Message(role="assistant", content=answer)],
+        ))
+    db.upsert_session(session)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# WORKFLOW PIPELINE
+# ══════════════════════════════════════════════════════════════════════════════
+
+
+def check_table_access(question: str, allowed_tables: list[str]) -> dict | None:
+    """Pré-check RBAC : réponse de refus si la question cible une table non autorisée, sinon None."""
     requested = detect_requested_tables(question)
     if requested:
         forbidden = requested - set(allowed_tables)
@@ -463,26 +641,135 @@ def run_pipeline(question: str, session_id: str | None = None, allowed_tables: l
                 "response": f"Accès refusé : vous n'avez pas la permission d'accéder aux données suivantes : **{table_names}**. Contactez votre administrateur pour obtenir les droits nécessaires.",
                 "sql_query": None,
             }
+    return None
 
-    state = PipelineState(allowed_tables, session_id)
 
-    pipeline = Workflow(
-        name="Text-to-SQL RBAC Pipeline",
-        steps=[
-            Step(name="Intent Analysis", executor=IntentExecutor(state)),
-            Step(name="RAG Schema Retrieval", executor=RAGSchemaExecutor()),
-            Step(name="SQL Generation", executor=SQLGeneratorExecutor(state)),
-            Step(name="SQL Security", executor=SQLSecurityExecutor(state)),
-            Step(name="DB Execution", executor=DBExecutorExecutor()),
-            Step(name="Response Formatting", executor=ResponseFormatterExecutor(state)),
-        ],
-    )
+def build_workflow(include_formatter: bool = True) -> Workflow:
+    """Construit le Workflow ; sans le formatter pour la variante streaming."""
+    steps = [
+        Step(name="RAG Schema Retrieval", executor=SchemaRetrievalExecutor()),
+        Step(name="Intent Analysis + SQL Generation", executor=IntentSQLExecutor()),
+        Step(name="SQL Security", executor=SQLSecurityExecutor()),
+        Step(name="DB Execution", executor=DBExecutorExecutor()),
+    ]
+    if include_formatter:
+        steps.append(Step(name="Response Formatting", executor=ResponseFormatterExecutor()))
+    return Workflow(name="Text-to-SQL RBAC Pipeline", steps=steps)
 
-    result = pipeline.run(input=question)
-    content = result.content if hasattr(result, "content") else str(result)
 
-    return {
+# Workflows construits une seule fois au chargement du module
+pipeline = build_workflow()
+pipeline_without_formatter = build_workflow(include_formatter=False)
+
+
+def _run_workflow(workflow: Workflow, state: PipelineState, question: str) -> str | None:
+    """Exécute un workflow partagé avec l'état de la requête positionné dans le ContextVar."""
+    token = _pipeline_state.set(state)
+    try:
+        result = workflow.run(input=question, session_id=state.session_id)
+    finally:
+        _pipeline_state.reset(token)
+    return result.content if hasattr(result, "content") else str(result)
+
+
+def _finalize(content: str | None, state: PipelineState, cache_key: str | None) -> dict:
+    """Construit le résultat final et le met en cache si l'exécution a abouti (cache_key fournie)."""
+    result = {
         "response": content or "Désolé, je n'ai pas pu traiter votre question.",
         "sql_query": state.sql_query,
     }
 
+    # Seules les exécutions abouties sont mises en cache (pas les rejets ni les erreurs)
+    if cache_key and content and state.sql_query:
+        with _response_cache_lock:
+            _response_cache[cache_key] = result
+    return dict(result)
+
+
+def _cached_response(cache_key: str) -> dict | None:
+    with _response_cache_lock:
+        cached = _response_cache.get(cache_key)
+    return dict(cached) if cached is not None else None
+
+
+def run_pipeline(
+    question: str, session_id: str | None = None, allowed_tables: list[str] | None = None, use_cache: bool = True
+) -> dict:
+    """Exécute le pipeline Text-to-SQL via un Workflow Agno avec filtrage RBAC.
+
+    use_cache=False pour un tour qui dépend de l'historique de la session (voir api.is_cacheable_turn).
+    """
+    if allowed_tables is None:
+        allowed_tables = list(ALL_TABLES)
+
+    # Pré-check : blocage strict si la question cible une table non autorisée
+    denied = check_table_access(question, allowed_tables)
+    if denied:
+        return denied
+
+    cache_key = response_cache_key(question, allowed_tables) if use_cache else None
+    if cache_key:
+        cached = _cached_response(cache_key)
+        if cached is not None:
+            record_cached_turn(question, cached, session_id, allowed_tables)
+            return cached
+
+    state = PipelineState(allowed_tables, session_id)
+    content = _run_workflow(pipeline, state, question)
+
+    return _finalize(content, state, cache_key)
+
+
+async def run_pipeline_async(
+    question: str, session_id: str | None = None, allowed_tables: list[str] | None = None, use_cache: bool = True
+) -> dict:
+    """Version async de run_pipeline pour les endpoints FastAPI : le pipeline tourne dans un thread
+    et la boucle d'événements reste libre pendant les appels LLM / DB."""
+    return await asyncio.to_thread(run_pipeline, question, session_id, allowed_tables, use_cache)
+
+
+def run_pipeline_stream(
+    question: str, session_id: str | None = None, allowed_tables: list[str] | None = None, use_cache: bool = True
+) -> Iterator[dict]:
+    """Variante streaming de run_pipeline.
+
+    Steps 1 à 4 exécutés par le Workflow, puis le Response Formatter est streamé :
+    produit des événements {"type": "token", "content"} puis un {"type": "done", "response", "sql_query"} final.
+    """
+    if allowed_tables is None:
+        allowed_tables = list(ALL_TABLES)
+
+    denied = check_table_access(question, allowed_tables)
+    if denied:
+        yield {"type": "done", **denied}
+        return
+
+    cache_key = response_cache_key(question, allowed_tables) if use_cache else None
+    cached = _cached_response(cache_key) if cache_key else None
+    if cached is not None:
+        record_cached_turn(question, cached, session_id, allowed_tables)
+        yield {"type": "token", "content": cached["response"]}
+        yield {"type": "done", **cached}
+        return
+
+    state = PipelineState(allowed_tables, session_id)
+    previous_content = _run_workflow(pipeline_without_formatter, state, question)
+
+    chunks = []
+    pending = []
+    pending_len = 0
+    last_flush = time.monotonic()
+    for chunk in ResponseFormatterExecutor.stream(previous_content or "", state):
+        chunks.append(chunk)
+        pending.append(chunk)
+        pending_len += len(chunk)
+        now = time.monotonic()
+        if pending_len >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+            yield {"type": "token", "content": "".join(pending)}
+            pending.clear()
+            pending_len = 0
+            last_flush = now
+    if pending:
+        yield {"type": "token", "content": "".join(pending)}
+
+    yield {"type": "done", **_finalize("".join(chunks), state, cache_key)}
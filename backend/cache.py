@@ -0,0 +1,70 @@
+"""
+Cache partagé des réponses (Redis, optionnel)
+==============================================
+Second niveau derrière le cache mémoire de agents.py : partagé entre les workers de l'API
+et conservé entre les redémarrages. Désactivé si REDIS_URL n'est pas défini.
+"""
+
+import json
+import os
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+REDIS_URL = os.getenv("REDIS_URL")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+KEY_PREFIX = "t2s:response:"
+
+_client = None
+
+
+async def init_redis():
+    """Connecte le client Redis si REDIS_URL est défini ; sinon le cache reste désactivé."""
+    global _client
+    if not REDIS_URL:
+        return
+    if aioredis is None:
+        print("[Cache] REDIS_URL défini mais le paquet redis est absent, cache Redis désactivé")
+        return
+    client = aioredis.from_url(REDIS_URL, decode_responses=True)
+    try:
+        await client.ping()
+    except Exception as e:
+        print(f"[Cache] Redis injoignable, cache Redis désactivé : {e}")
+        await client.aclose()
+        return
+    _client = client
+    print("[Cache] Redis prêt.")
+
+
+async def close_redis():
+    """Ferme le client Redis."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_cached_response(key: str) -> dict | None:
+    """Réponse mise en cache pour cette clé (voir agents.response_cache_key), ou None."""
+    if _client is None:
+        return None
+    try:
+        raw = await _client.get(KEY_PREFIX + key)
+    except Exception as e:
+        print(f"[Cache] Erreur lecture Redis : {e}")
+        return None
+    return json.loads(raw) if raw else None
+
+
+async def set_cached_response(key: str, result: dict):
+    """Met en cache une réponse aboutie (avec SQL exécuté) pendant RESPONSE_CACHE_TTL secondes."""
+    if _client is None or not result.get("sql_query"):
+        return
+    payload = {"response": result["response"], "sql_query": result["sql_query"]}
+    try:
+        await _client.set(KEY_PREFIX + key, json.dumps(payload, ensure_ascii=False), ex=RESPONSE_CACHE_TTL)
+    except Exception as e:
+        print(f"[Cache] Erreur écriture Redis : {e}")
@@ -0,0 +1,93 @@
+"""
+Embedder : SentenceTransformer avec cache des embeddings.
+==========================================================
+Le modèle est chargé une seule fois par processus (instance partagée par PgVector),
+en ONNX quantifié int8 par défaut, et les embeddings des requêtes déjà vues sont
+servis depuis un cache LRU.
+"""
+
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from agno.knowledge.embedder.sentence_transformer import SentenceTransformerEmbedder
+from sentence_transformers import SentenceTransformer
+
+# Export ONNX int8 (quantification dynamique AVX-512 VNNI) publié avec le modèle sur le Hub
+ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+@dataclass
+class CachedSentenceTransformerEmbedder(SentenceTransformerEmbedder):
+    """SentenceTransformerEmbedder avec cache LRU (clé SHA-1 du texte, vecteurs stockés en float16)."""
+
+    cache_size: int = 4096
+    quantized: bool = True
+    _cache: "OrderedDict[str, np.ndarray]" = field(default_factory=OrderedDict, init=False, repr=False, compare=False)
+    _cache_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.sentence_transformer_client is None and self.quantized:
+            try:
+                self.sentence_transformer_client = SentenceTransformer(
+                    model_name_or_path=self.id,
+                    backend="onnx",
+                    model_kwargs={"file_name": ONNX_INT8_FILE},
+                )
+            except Exception as e:
+                print(f"[Embedder] ONNX int8 indisponible, repli sur le modèle fp32 : {e}")
+                # quantized reflète le modèle réellement chargé (empreinte des vecteurs en base)
+                self.quantized = False
+        super().__post_init__()
+
+    def get_embedding(self, text: Union[str, List[str]]) -> List[float]:
+        # Les lots (list[str]) ne passent pas par le cache
+        if not isinstance(text, str):
+            return super().get_embedding(text)
+
+        key = hashlib.sha1(text.encode()).hexdigest()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached.astype(np.float32).tolist()
+
+        embedding = super().get_embedding(text)
+        if not embedding:
+            return embedding
+
+        # float16 : moitié moins de mémoire par entrée ; même valeur servie au miss et au hit
+        vector = np.asarray(embedding, dtype=np.float16)
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return vector.astype(np.float32).tolist()
+
+    def get_embeddings_batch_and_usage(self, texts: List[str]) -> Tuple[List[List[float]], List[Optional[Dict]]]:
+        """Encode un lot en un seul appel (chargement de la knowledge base, enable_batch=True).
+
+        SentenceTransformer.encode trie déjà les textes par longueur avant de découper en
+        sous-lots de batch_size (padding minimal) puis restaure l'ordre d'origine.
+        """
+        if self.sentence_transformer_client is None:
+            raise RuntimeError("SentenceTransformer model not initialized")
+        embeddings = self.sentence_transformer_client.encode(
+            texts,
+            batch_size=self.batch_size,
+            prompt=self.prompt,
+            normalize_embeddings=self.normalize_embeddings,
+            convert_to_numpy=True,
+        )
+        return embeddings.tolist(), [None] * len(texts)
+
+    async def async_get_embeddings_batch_and_usage(
+        self, texts: List[str]
+    ) -> Tuple[List[List[float]], List[Optional[Dict]]]:
+        """Version async : l'encodage (CPU) tourne dans un thread."""
+        return await asyncio.to_thread(self.get_embeddings_batch_and_usage, texts)
@@ -5,12 +5,39 @@ Utilise le système natif BaseGuardrail d'Agno.
 """
 
 import re
+from functools import lru_cache
 
 from agno.guardrails import BaseGuardrail
 from agno.exceptions import InputCheckError, CheckTrigger
 from agno.run.agent import RunInput
 
 
+# ── Compilation des patterns ──────────────────────────────────────────────────
+# Un pattern `\b(mot1|mot2|...)\b` à alternatives littérales équivaut, pour chaque alternative
+# d'un seul mot, à l'appartenance de ce mot à l'ensemble des mots (\w+) du texte : ces mots sont
+# testés par un seul isdisjoint, seules les expressions multi-mots et les vraies regex restent.
+
+WORD_RE = re.compile(r"\w+")
+LITERAL_ALTERNATION = re.compile(r"\\b\(([^()\\\[\]?*+.{}^$]+)\)\\b")
+
+
+def _compile_patterns(patterns: list[str], flags: int = 0) -> tuple[frozenset[str], list[re.Pattern]]:
+    """Sépare les mots isolés (frozenset, en minuscules) des patterns à évaluer en regex (compilés)."""
+    words = set()
+    regexes = []
+    for pattern in patterns:
+        match = LITERAL_ALTERNATION.fullmatch(pattern)
+        if match is None:
+            regexes.append(re.compile(pattern, flags))
+            continue
+        alternatives = match.group(1).split("|")
+        words.update(alt.lower() for alt in alternatives if WORD_RE.fullmatch(alt))
+        phrases = [re.escape(alt) for alt in alternatives if not WORD_RE.fullmatch(alt)]
+        if phrases:
+            regexes.append(re.compile(r"\b(" + "|".join(phrases) + r")\b", flags))
+    return frozenset(words), regexes
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # 1. SALUTATIONS - Détection des greetings pour réponse accueillante
 # ══════════════════════════════════════════════════════════════════════════════
@@ -19,7 +46,7 @@ GREETING_PATTERNS = [
     # Salutations FR
     r"\b(bonjour|bonsoir|salut|coucou|hey|wesh|yo|salam)\b",
     # Salutations EN
-    r"\b(hello|hi|hey|good morning|good evening|good afternoon)\b",
+    r"\b(hello|hi|good morning|good evening|good afternoon)\b",
     # Remerciements / Au revoir
     r"\b(merci|au revoir|bye|goodbye|à bientôt|à plus|adieu|bonne journée|bonne soirée)\b",
     # Questions sur l'identité du bot
@@ -29,6 +56,8 @@ GREETING_PATTERNS = [
     r"\b(aide|help|comment ça marche|comment utiliser|tu peux m'aider)\b",
     r"\b(que (peux|sais)-tu faire|tes capacités|tes fonctionnalités)\b",
 ]
+# Compilés une fois à l'import ; appliqués sur le texte en minuscules (sans flag)
+GREETING_WORDS, GREETING_REGEXES = _compile_patterns(GREETING_PATTERNS)
 
 GREETING_RESPONSE = (
     "Bonjour ! Je suis votre **AI Data Assistant**.\n\n"
@@ -91,7 +120,7 @@ OFF_TOPIC_PATTERNS = [
     r"\b(vétérinaire|cheval|serpent|araignée|insecte|zoo|aquarium)\b",
     # ── Éducation ──
     r"\b(école|université|examen|cours|diplôme|étudiant|professeur)\b",
-    r"\b(baccalauréat|licence|master|doctorat|thèse|scolaire|bourse)\b",
+    r"\b(baccalauréat|licence|master|doctorat|thèse|scolaire)\b",
     # ── Religion / Spiritualité ──
     r"\b(religion|dieu|église|mosquée|synagogue|temple|prière|bible|coran)\b",
     r"\b(foi|spirituel|croyance|athée|bouddhisme|islam|christianisme)\b",
@@ -105,7 +134,7 @@ OFF_TOPIC_PATTERNS = [
     r"\b(horoscope|astrologie|signe|zodiaque|verseau|balance|scorpion)\b",
     r"\b(tarot|voyance|médium|ésotéri|paranormal|fantôme|ovni)\b",
     # ── Culture générale / Géographie ──
-    r"\b(capitale|population|superficie|continent|océan|fleuve|montagne)\b",
+    r"\b(capitale|population|superficie|continent|océan|fleuve)\b",
     r"\b(roi|reine|empereur|guerre|bataille|révolution|siècle|histoire)\b",
     # ── Sciences ──
     r"\b(mathématique|physique|chimie|biologie|formule|équation|atome)\b",
@@ -121,7 +150,7 @@ OFF_TOPIC_PATTERNS = [
     r"\b(actualité|nouvelles|journal|infos|presse|média|reporter|journaliste)\b",
     # ── Finance personnelle ──
     r"\b(bourse|bitcoin|crypto|action|investir|épargne|placement|trading)\b",
-    r"\b(impôt|taxe|retraite|assurance|banque|crédit|prêt|hypothèque)\b",
+    r"\b(impôt|taxe|retraite|assurance|banque|crédit|prêt)\b",
     # ── Bricolage / Jardinage ──
     r"\b(bricolage|jardinage|plante|fleur|arbre|pelouse|potager|outil)\b",
     r"\b(peinture|plomberie|électricité|carrelage|rénovation|menuiserie)\b",
@@ -129,6 +158,7 @@ OFF_TOPIC_PATTERNS = [
     r"\b(smartphone|iphone|samsung|android|ios|tablette|gadget)\b",
     r"\b(wifi|bluetooth|5g|fibre|internet|réseau social|facebook|instagram|tiktok)\b",
 ]
+OFF_TOPIC_WORDS, OFF_TOPIC_REGEXES = _compile_patterns(OFF_TOPIC_PATTERNS)
 
 OFF_TOPIC_RESPONSE = (
     "Désolé, je ne suis pas en mesure de répondre à ce type de question. "
@@ -182,6 +212,7 @@ SQL_INJECTION_PATTERNS = [
     r"\b(enlève[rz]?|enlever|retire[rz]?|retirer)\b",
     r"\b(restaure[rz]?|restaurer|migre[rz]?|migrer)\b",
 ]
+SQL_INJECTION_WORDS, SQL_INJECTION_REGEXES = _compile_patterns(SQL_INJECTION_PATTERNS, re.IGNORECASE)
 
 DESTRUCTIVE_RESPONSE = (
     "Je ne peux pas effectuer d'opérations de modification sur la base de données. "
@@ -236,6 +267,7 @@ PROMPT_INJECTION_PATTERNS = [
     r"\b(override|outrepasse[rz]?|surcharge[rz]?|dépasse[rz]?)\b",
     r"(priorité\s+maximale|highest\s+priority|urgent\s+override)",
 ]
+PROMPT_INJECTION_WORDS, PROMPT_INJECTION_REGEXES = _compile_patterns(PROMPT_INJECTION_PATTERNS, re.IGNORECASE)
 
 PROMPT_INJECTION_RESPONSE = (
     "Tentative de manipulation détectée. Je ne peux pas modifier mon comportement.\n\n"
@@ -251,38 +283,65 @@ PROMPT_INJECTION_RESPONSE = (
 # FONCTIONS DE VÉRIFICATION (utilisées au niveau API)
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _matches_any(words: frozenset[str], regexes: list[re.Pattern], tokens: set[str], text: str) -> bool:
+    """Vrai si un mot du texte (tokens, en minuscules) est dans words ou si une regex correspond."""
+    if not words.isdisjoint(tokens):
+        return True
+    for regex in regexes:
+        if regex.search(text):
+            return True
+    return False
+
+
+def _tokens(text_lower: str) -> set[str]:
+    return set(WORD_RE.findall(text_lower))
+
+
+# Fonctions pures du texte : résultats mis en cache (questions relancées ou rejouées par l'UI)
+GUARDRAIL_CACHE_SIZE = 2048
+
+
+@lru_cache(maxsize=GUARDRAIL_CACHE_SIZE)
 def is_greeting(text: str) -> bool:
     """Vérifie si le texte est une salutation ou demande d'aide."""
     text_lower = text.lower()
-    for pattern in GREETING_PATTERNS:
-        if re.search(pattern, text_lower):
-            return True
-    return False
+    return _matches_any(GREETING_WORDS, GREETING_REGEXES, _tokens(text_lower), text_lower)
 
 
+@lru_cache(maxsize=GUARDRAIL_CACHE_SIZE)
 def is_off_topic(text: str) -> bool:
     """Vérifie si le texte est une question hors-sujet."""
     text_lower = text.lower()
-    for pattern in OFF_TOPIC_PATTERNS:
-        if re.search(pattern, text_lower):
-            return True
-    return False
+    return _matches_any(OFF_TOPIC_WORDS, OFF_TOPIC_REGEXES, _tokens(text_lower), text_lower)
 
 
+@lru_cache(maxsize=GUARDRAIL_CACHE_SIZE)
 def is_destructive(text: str) -> bool:
     """Vérifie si le texte contient une intention destructrice (SQL injection ou action FR)."""
-    for pattern in SQL_INJECTION_PATTERNS:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
-    return False
+    return _matches_any(SQL_INJECTION_WORDS, SQL_INJECTION_REGEXES, _tokens(text.lower()), text)
 
 
+@lru_cache(maxsize=GUARDRAIL_CACHE_SIZE)
 def is_prompt_injection(text: str) -> bool:
     """Vérifie si le texte tente de manipuler l'IA (prompt injection)."""
-    for pattern in PROMPT_INJECTION_PATTERNS:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
-    return False
+    return _matches_any(PROMPT_INJECTION_WORDS, PROMPT_INJECTION_REGEXES, _tokens(text.lower()), text)
+
+
+@lru_cache(maxsize=GUARDRAIL_CACHE_SIZE)
+def classify_question(text: str) -> str | None:
+    """Guardrails pré-pipeline en un seul appel : retourne la réponse prédéfinie de la première
+    catégorie détectée (salutation > hors-sujet > destructif > prompt injection), ou None."""
+    text_lower = text.lower()
+    tokens = _tokens(text_lower)
+    if _matches_any(GREETING_WORDS, GREETING_REGEXES, tokens, text_lower):
+        return GREETING_RESPONSE
+    if _matches_any(OFF_TOPIC_WORDS, OFF_TOPIC_REGEXES, tokens, text_lower):
+        return OFF_TOPIC_RESPONSE
+    if _matches_any(SQL_INJECTION_WORDS, SQL_INJECTION_REGEXES, tokens, text):
+        return DESTRUCTIVE_RESPONSE
+    if _matches_any(PROMPT_INJECTION_WORDS, PROMPT_INJECTION_REGEXES, tokens, text):
+        return PROMPT_INJECTION_RESPONSE
+    return None
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -294,13 +353,11 @@ class TopicGuardrail(BaseGuardrail):
 
     def check(self, run_input: RunInput) -> None:
         if isinstance(run_input.input_content, str):
-            text = run_input.input_content.lower()
-            for pattern in OFF_TOPIC_PATTERNS:
-                if re.search(pattern, text):
-                    raise InputCheckError(
-                        OFF_TOPIC_RESPONSE,
-                        check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
-                    )
+            if is_off_topic(run_input.input_content):
+                raise InputCheckError(
+                    OFF_TOPIC_RESPONSE,
+                    check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
+                )
 
     async def async_check(self, run_input: RunInput) -> None:
         self.check(run_input)
@@ -311,13 +368,11 @@ class SQLInjectionGuardrail(BaseGuardrail):
 
     def check(self, run_input: RunInput) -> None:
         if isinstance(run_input.input_content, str):
-            text = run_input.input_content
-            for pattern in SQL_INJECTION_PATTERNS:
-                if re.search(pattern, text, re.IGNORECASE):
-                    raise InputCheckError(
-                        DESTRUCTIVE_RESPONSE,
-                        check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
-                    )
+            if is_destructive(run_input.input_content):
+                raise InputCheckError(
+                    DESTRUCTIVE_RESPONSE,
+                    check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
+                )
 
     async def async_check(self, run_input: RunInput) -> None:
         self.check(run_input)
@@ -328,24 +383,30 @@ class PromptInjectionGuardrail(BaseGuardrail):
 
     def check(self, run_input: RunInput) -> None:
         if isinstance(run_input.input_content, str):
-            text = run_input.input_content
-            for pattern in PROMPT_INJECTION_PATTERNS:
-                if re.search(pattern, text, re.IGNORECASE):
-                    raise InputCheckError(
-                        PROMPT_INJECTION_RESPONSE,
-                        check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
-                    )
+            if is_prompt_injection(run_input.input_content):
+                raise InputCheckError(
+                    PROMPT_INJECTION_RESPONSE,
+                    check_trigger=CheckTrigger.INPUT_NOT_ALLOWED,
+                )
 
     async def async_check(self, run_input: RunInput) -> None:
         self.check(run_input)
 
 
+# Patterns pour données sensibles en sortie
+# Partie locale possessive (++) : « @ » n'en faisant pas partie, revenir en arrière ne peut rien
+# trouver de plus ; le moteur abandonne aussitôt au lieu de reculer caractère par caractère
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9._%+-]++@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
+PHONE_PATTERN = re.compile(r"\b0[1-9][\s.-]?\d{2}[\s.-]?\d{2}[\s.-]?\d{2}[\s.-]?\d{2}\b")
+
+
 class OutputSafetyGuardrail(BaseGuardrail):
     """Masque les emails et données sensibles dans la réponse."""
 
     def check(self, run_input: RunInput) -> None:
         if isinstance(run_input.input_content, str):
-            # Masquer les emails
+            # Emails d'abord : un numéro collé à une adresse (« 78.jean@… ») ne doit pas en
+            # consommer le début avant que l'adresse ne soit masquée
             run_input.input_content = EMAIL_PATTERN.sub("***@***.com", run_input.input_content)
             # Masquer les numéros de téléphone
             run_input.input_content = PHONE_PATTERN.sub("** ** ** ** **", run_input.input_content)
@@ -353,7 +414,3 @@ class OutputSafetyGuardrail(BaseGuardrail):
     async def async_check(self, run_input: RunInput) -> None:
         self.check(run_input)
 
-
-# Patterns pour données sensibles en sortie
-EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
-PHONE_PATTERN = re.compile(r"\b0[1-9][\s.-]?\d{2}[\s.-]?\d{2}[\s.-]?\d{2}[\s.-]?\d{2}\b")
@@ -0,0 +1,30 @@
+"""
+Configuration Gunicorn (production)
+====================================
+Workers Uvicorn (uvloop + httptools via uvicorn[standard]) supervisés par Gunicorn.
+
+Usage : gunicorn api:app -c gunicorn.conf.py
+"""
+
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# Défaut fixe (pas 2 × CPU + 1) : chaque worker charge son propre modèle d'embedding et ouvre
+# ses propres pools PostgreSQL — jusqu'à 20 (asyncpg, db.py) + 10 (psycopg2, tools.py)
+# + 15 (SQLAlchemy agno, 5 + 10 en débordement) connexions. Borne à respecter :
+#   WEB_CONCURRENCY × 45 ≤ max_connections (100 par défaut)
+# Derrière PgBouncer (DATABASE_URL_POOLED), la part asyncpg devient DEFAULT_POOL_SIZE pour tous
+# les workers : 20 + WEB_CONCURRENCY × 25 ≤ max_connections
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Les appels LLM du pipeline peuvent durer plusieurs dizaines de secondes
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Pas de log d'accès en production (coût mesurable par requête) ; erreurs sur stderr
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
@@ -0,0 +1,105 @@
+"""
+Migrations du schéma applicatif (users, conversation_history, métadonnées RAG)
+==============================================================================
+Migrations versionnées, appliquées une seule fois et suivies dans la table schema_migrations.
+Un verrou consultatif PostgreSQL sérialise l'exécution entre les workers de l'API.
+
+Usage : python migrations.py  (également exécuté au démarrage de l'API)
+"""
+
+import asyncio
+
+import asyncpg
+
+from db import DB_URL_PSYCOPG2, get_pool
+
+# Clé du verrou consultatif (pg_advisory_xact_lock) propre aux migrations de l'application
+MIGRATIONS_LOCK_ID = 7_420_001
+
+# (version, description, SQL) — ne jamais modifier une migration déjà appliquée : en ajouter une
+MIGRATIONS = [
+    (1, "table users + colonnes RBAC", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) NOT NULL,
+            email VARCHAR(200) UNIQUE NOT NULL,
+            hashed_password VARCHAR(255) NOT NULL,
+            role VARCHAR(20) NOT NULL DEFAULT 'user',
+            allowed_tables JSONB NOT NULL DEFAULT '["clients", "produits", "commandes"]',
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS role VARCHAR(20) NOT NULL DEFAULT 'user';
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS allowed_tables JSONB NOT NULL DEFAULT '["clients", "produits", "commandes"]';
+    """),
+    (2, "table conversation_history + index", """
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id SERIAL PRIMARY KEY,
+            session_id VARCHAR(100) NOT NULL,
+            user_id INTEGER,
+            question TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_session ON conversation_history(session_id);
+        CREATE INDEX IF NOT EXISTS idx_history_date ON conversation_history(created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_history_user ON conversation_history(user_id);
+    """),
+    (3, "index historique (user_id, created_at DESC)", """
+        -- /api/history : WHERE user_id = $1 ORDER BY created_at DESC LIMIT $2, servi par un seul
+        -- parcours d'index déjà trié ; remplace l'index user_id seul (préfixe du composite)
+        CREATE INDEX IF NOT EXISTS idx_history_user_date ON conversation_history(user_id, created_at DESC);
+        DROP INDEX IF EXISTS idx_history_user;
+    """),
+    (4, "table rag_schema_contents_meta (empreinte de la knowledge base)", """
+        -- Lue par agents.is_knowledge_up_to_date() : rechargement de schema_docs.md ignoré si inchangé
+        CREATE TABLE IF NOT EXISTS rag_schema_contents_meta (
+            key VARCHAR(100) PRIMARY KEY,
+            hash VARCHAR(64) NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """),
+]
+
+
+async def apply_migrations(conn: asyncpg.Connection):
+    """Applique les migrations manquantes, dans une transaction protégée par le verrou consultatif."""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        applied = {row[0] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+
+        pending = [m for m in MIGRATIONS if m[0] not in applied]
+        for version, description, sql in pending:
+            await conn.execute(sql)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                version, description,
+            )
+            print(f"[Migrations] {version} appliquée : {description}")
+
+    if not pending:
+        print("[Migrations] Schéma à jour.")
+
+
+async def run_migrations():
+    """Applique les migrations via le pool partagé de l'API."""
+    async with get_pool().acquire() as conn:
+        await apply_migrations(conn)
+
+
+async def main():
+    conn = await asyncpg.connect(DB_URL_PSYCOPG2)
+    try:
+        await apply_migrations(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
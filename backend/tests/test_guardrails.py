@@ -0,0 +1,52 @@
+"""
+Tests de guardrails.OutputSafetyGuardrail : masquage des emails et téléphones
+============================================================================
+
+Usage : cd backend && python -m unittest discover tests
+"""
+
+import unittest
+from types import SimpleNamespace
+
+from guardrails import OutputSafetyGuardrail
+
+
+def mask(text: str) -> str:
+    run_input = SimpleNamespace(input_content=text)
+    OutputSafetyGuardrail().check(run_input)
+    return run_input.input_content
+
+
+class OutputSafetyGuardrailTest(unittest.TestCase):
+    def test_each_mask_in_mixed_text(self):
+        cases = {
+            "Email : jean.dupont@mail.fr": "Email : ***@***.com",
+            "Tél : 06 12 34 56 78": "Tél : ** ** ** ** **",
+            "Tél : 01.23.45.67.89 / 0612345678": "Tél : ** ** ** ** ** / ** ** ** ** **",
+            "Jean (jean@mail.fr, 06-12-34-56-78) et Marie (marie+crm@societe.com, 01 23 45 67 89)": (
+                "Jean (***@***.com, ** ** ** ** **) et Marie (***@***.com, ** ** ** ** **)"
+            ),
+            '{"rows": [["Dupont", "06 12 34 56 78", "dupont@mail.fr"]]}': (
+                '{"rows": [["Dupont", "** ** ** ** **", "***@***.com"]]}'
+            ),
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(mask(text), expected)
+
+    def test_text_without_sensitive_data_is_unchanged(self):
+        text = "Commande 2024-06-12 : 1234567 articles, 12 34 56, created_at@"
+        self.assertEqual(mask(text), text)
+
+    def test_email_right_after_phone_is_masked(self):
+        masked = mask("Contact : 06 12 34 56 78.jean@mail.fr")
+        self.assertNotIn("@mail.fr", masked)
+        self.assertNotIn("jean", masked)
+        self.assertEqual(masked, "Contact : 06 12 34 56 ***@***.com")
+
+    def test_email_glued_to_phone_is_masked(self):
+        self.assertEqual(mask("06 12 34 56 78@mail.fr"), "06 12 34 56 ***@***.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
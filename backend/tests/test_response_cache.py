@@ -0,0 +1,160 @@
+"""
+Tests des caches de réponses (mémoire et Redis) : contexte conservé après un tour servi depuis le cache
+======================================================================================================
+La mémoire Agno est une InMemoryDb ; le LLM est remplacé au niveau HTTP (httpx.MockTransport),
+les agents et leur construction d'historique sont les vrais. Côté API, Redis et le pool asyncpg
+sont simulés.
+
+Usage : cd backend && python -m unittest discover tests
+"""
+
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from agno.db.in_memory import InMemoryDb
+from cachetools import TTLCache
+
+import agents
+import api
+
+TABLES = ["clients", "commandes"]
+FIRST_QUESTION = "Combien de clients actifs ?"
+CACHED = {"response": "Il y a 42 clients actifs.", "sql_query": "SELECT COUNT(*) FROM clients WHERE statut = 'actif'"}
+FOLLOW_UP = "Et parmi ces clients, combien ont passé une commande ?"
+
+
+class FakeMistral:
+    """Répond comme l'API Mistral et garde les messages reçus à chaque appel."""
+
+    def __init__(self):
+        self.requests: list[list[dict]] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body["messages"])
+        answer = json.dumps({"intent": "suivi", "sql": "SELECT COUNT(DISTINCT client_id) FROM commandes"})
+        return httpx.Response(200, json={
+            "id": "test", "object": "chat.completion", "model": body["model"], "created": 0,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+
+class CachedTurnContextTest(unittest.TestCase):
+    def setUp(self):
+        self.db = InMemoryDb()
+        self.llm = FakeMistral()
+        http_client = httpx.Client(transport=httpx.MockTransport(self.llm))
+        for name, value in (
+            ("get_memory_db", lambda: self.db),
+            ("_http_client", http_client),
+            ("_response_cache", TTLCache(maxsize=16, ttl=600)),
+        ):
+            patcher = mock.patch.object(agents, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Agents reconstruits sur la mémoire et le client HTTP de test
+        for factory in (agents.get_intent_sql_agent, agents.get_response_formatter_agent):
+            factory.cache_clear()
+            self.addCleanup(factory.cache_clear)
+        agents._response_cache[agents.response_cache_key(FIRST_QUESTION, TABLES)] = dict(CACHED)
+
+    def assert_follow_up_has_context(self, session_id: str):
+        # Question de suivi : le vrai agent SQL, avec l'historique que construit Agno
+        agents.get_intent_sql_agent(frozenset(TABLES)).run(FOLLOW_UP, session_id=session_id)
+        contents = [message["content"] for message in self.llm.requests[-1]]
+        self.assertIn(FIRST_QUESTION, contents)
+        self.assertTrue(any(CACHED["sql_query"] in str(content) for content in contents))
+        self.assertEqual(contents[-1], FOLLOW_UP)
+
+        formatter_history = agents.get_response_formatter_agent().get_session_messages(
+            session_id, last_n_runs=agents.HISTORY_RUNS
+        )
+        self.assertIn(CACHED["response"], [message.content for message in formatter_history])
+
+    def test_follow_up_after_cache_hit_keeps_context(self):
+        with mock.patch.object(agents, "_run_workflow", side_effect=AssertionError("pipeline exécuté")):
+            result = agents.run_pipeline(FIRST_QUESTION, session_id="session-1", allowed_tables=TABLES)
+        self.assertEqual(result, CACHED)
+        self.assertEqual(self.llm.requests, [])
+
+        self.assert_follow_up_has_context("session-1")
+
+    def test_follow_up_after_streamed_cache_hit_keeps_context(self):
+        with mock.patch.object(agents, "_run_workflow", side_effect=AssertionError("pipeline exécuté")):
+            events = list(agents.run_pipeline_stream(FIRST_QUESTION, session_id="session-2", allowed_tables=TABLES))
+        self.assertEqual(events[-1], {"type": "done", **CACHED})
+
+        self.assert_follow_up_has_context("session-2")
+
+
+class FakePool:
+    """Pool asyncpg simulé : aucune ligne d'historique, requêtes reçues conservées."""
+
+    def __init__(self):
+        self.queries: list[tuple] = []
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def fetchval(self, sql: str, *args):
+        self.queries.append((sql, *args))
+        return True
+
+
+class RedisCachedTurnContextTest(CachedTurnContextTest):
+    """Même scénario, la réponse venant du cache Redis de l'API."""
+
+    user = {"user_id": 7, "allowed_tables": TABLES}
+
+    def setUp(self):
+        super().setUp()
+        agents._response_cache.clear()  # seul Redis connaît la réponse
+        self.pool = FakePool()
+        for name, value in (
+            ("get_pool", lambda: self.pool),
+            ("get_cached_response", mock.AsyncMock(return_value=dict(CACHED))),
+            ("set_cached_response", mock.AsyncMock()),
+            ("run_pipeline_async", mock.AsyncMock(side_effect=AssertionError("pipeline exécuté"))),
+            ("run_pipeline_stream", mock.Mock(side_effect=AssertionError("pipeline exécuté"))),
+        ):
+            patcher = mock.patch.object(api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(api.app, "state", SimpleNamespace(history_queue=asyncio.Queue()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_follow_up_after_cache_hit_keeps_context(self):
+        request = api.AskRequest(question=FIRST_QUESTION, session_id="session-3")
+        response = asyncio.run(api.ask_question(request, user=self.user))
+        self.assertEqual(response.response, CACHED["response"])
+        # Premier tour vérifié pour la session ET l'utilisateur authentifié
+        self.assertEqual(self.pool.queries, [(api.FIRST_TURN_SQL, "session-3", 7)])
+
+        self.assert_follow_up_has_context("session-3")
+
+    def test_follow_up_after_streamed_cache_hit_keeps_context(self):
+        async def stream() -> list[str]:
+            request = api.AskRequest(question=FIRST_QUESTION, session_id="session-4")
+            response = await api.ask_question_stream(request, user=self.user)
+            return [event async for event in response.body_iterator]
+
+        events = asyncio.run(stream())
+        self.assertIn(CACHED["sql_query"], events[-1])
+
+        self.assert_follow_up_has_context("session-4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+Tests de tools.execute_sql_readonly : pool psycopg2 + cache de prepared statements
+===================================================================================
+Le vrai ThreadedConnectionPool de psycopg2 est utilisé ; seules les connexions sont simulées
+(FakeConnection garde, comme le serveur, ses propres statements préparés).
+
+Usage : cd backend && python -m unittest discover tests
+"""
+
+import random
+import threading
+import time
+import unittest
+import weakref
+from types import SimpleNamespace
+from unittest import mock
+
+import orjson
+from psycopg2.errors import DuplicatePreparedStatement, InvalidSqlStatementName
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+
+import tools
+
+
+class FakeCursor:
+    def __init__(self, conn: "FakeConnection"):
+        self.conn = conn
+        self.description = None
+        self._rows = []
+
+    def execute(self, sql: str):
+        if not self.conn.autocommit:
+            raise AssertionError("connexion utilisée hors autocommit")
+        verb, name = sql.split()[:2]
+        prepared = self.conn.server_prepared
+        if verb == "PREPARE":
+            if name in prepared:
+                raise DuplicatePreparedStatement(f'prepared statement "{name}" already exists')
+            prepared.add(name)
+        elif verb == "DEALLOCATE":
+            if name not in prepared:
+                raise InvalidSqlStatementName(f'prepared statement "{name}" does not exist')
+            prepared.discard(name)
+        elif verb == "EXECUTE":
+            if name not in prepared:
+                raise InvalidSqlStatementName(f'prepared statement "{name}" does not exist')
+            time.sleep(random.random() / 1000)  # aller-retour serveur de durée variable : les threads s'entrelacent
+            self.description = [("n",)]
+            self._rows = [(name,)]
+        else:
+            raise AssertionError(f"commande inattendue : {sql}")
+
+    def fetchmany(self, size: int):
+        return self._rows[:size]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Connexion simulée : statements préparés propres à la session, comme côté PostgreSQL."""
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.server_prepared: set[str] = set()
+        self.info = SimpleNamespace(transaction_status=TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class ExecuteSqlReadonlyTest(unittest.TestCase):
+    def setUp(self):
+        self.connects = 0
+        patcher = mock.patch("psycopg2.pool.psycopg2.connect", self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Mêmes bornes que tools.get_pool() : au-delà d'une connexion libre, le pool ferme au retour
+        self.pool = ThreadedConnectionPool(1, 10)
+        for name, value in (("_pool", self.pool), ("_prepared", weakref.WeakKeyDictionary())):
+            patcher = mock.patch.object(tools, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def connect(self, *args, **kwargs) -> FakeConnection:
+        # Compteur seulement : garder les connexions empêcherait la réutilisation de leur id()
+        self.connects += 1
+        return FakeConnection()
+
+    def run_query(self, query: str) -> dict:
+        result = tools.execute_sql_readonly(query)
+        self.assertFalse(result.startswith("ERREUR"), result)
+        return orjson.loads(result)
+
+    def test_concurrent_calls_through_pool(self):
+        queries = [f"SELECT {i} AS n" for i in range(5)]
+        errors = []
+        start = threading.Barrier(8)
+
+        def worker():
+            start.wait()
+            for i in range(200):
+                time.sleep(random.random() / 1000)  # reste du pipeline : nombre variable de connexions empruntées
+                result = tools.execute_sql_readonly(queries[i % len(queries)])
+                if result.startswith("ERREUR"):
+                    errors.append(result)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(self.connects, 1)  # connexions fermées au retour puis rouvertes
+        for conn in list(tools._prepared.keys()):
+            self.assertEqual(set(tools._prepared[conn]), conn.server_prepared)
+
+    def test_statement_lost_on_server_is_prepared_again(self):
+        self.run_query("SELECT 1 AS n")
+        conn = self.pool._pool[0]
+        conn.server_prepared.clear()  # DISCARD ALL / session rouverte côté serveur
+
+        self.assertEqual(self.run_query("SELECT 1 AS n")["row_count"], 1)
+        self.assertEqual(set(tools._prepared[conn]), conn.server_prepared)
+
+    def test_lru_eviction_tolerates_missing_statement(self):
+        with mock.patch.object(tools, "MAX_PREPARED_PER_CONNECTION", 2):
+            self.run_query("SELECT 1 AS n")
+            self.run_query("SELECT 2 AS n")
+            conn = self.pool._pool[0]
+            conn.server_prepared.clear()
+
+            # Le DEALLOCATE du plus ancien échoue (26000) sans faire échouer la requête
+            self.run_query("SELECT 3 AS n")
+            self.assertEqual(len(tools._prepared[conn]), 2)
+            self.run_query("SELECT 2 AS n")
+            self.assertEqual(set(tools._prepared[conn]), conn.server_prepared)
+
+
+if __name__ == "__main__":
+    unittest.main()